@@ -1,11 +1,19 @@
 import time
-from datetime import time as dt_time, datetime
+from datetime import time as dt_time, datetime, date
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import plotly.graph_objects as go
 import streamlit as st
 from streamlit_autorefresh import st_autorefresh
 from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from pymongo.errors import ConnectionFailure, PyMongoError
+from streamlit.runtime.scriptrunner import StopException
 import re
 import plotly.express as px
 import warnings
@@ -35,64 +43,15 @@ def carregar_dados():
     df["created_at"] = pd.to_datetime(df["created_at"])
     return df
 
-st.set_page_config(
-    page_title="Meu Dashboard",
-    layout="wide",
-    initial_sidebar_state="expanded",
-)
-
-# Atualização periódica a cada 10 minutos
-_ = st_autorefresh(interval=600_000, limit=None, key="auto_refresh")
-
-# Carrega os dados
-df = carregar_dados()
-
-# -------------------------------
-# Status da conexão e atualização
-# -------------------------------
-col1, col2 = st.columns(2)
-
-with col1:
-    try:
-        get_client().admin.command("ping")
-        st.success("✅ Conectado ao MongoDB")
-    except:
-        st.error("❌ Falha na conexão com o MongoDB")
-
-with col2:
-    st.caption(f"📅 Atualizado em: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
-
-# -------------------------------
-# Filtros de data e horário
-# -------------------------------
-data_min = df['created_at'].min().date()
-data_max = df['created_at'].max().date()
-data_inicio = st.sidebar.date_input("Data inicial", value=data_min, min_value=data_min, max_value=data_max)
-data_fim = st.sidebar.date_input("Data final", value=data_max, min_value=data_min, max_value=data_max)
-df_filtrado = df[(df['created_at'].dt.date >= data_inicio) & (df['created_at'].dt.date <= data_fim)]
-
-hora_inicio = st.sidebar.time_input("Hora inicial", value=dt_time(0, 1))
-hora_fim = st.sidebar.time_input("Hora final", value=dt_time(23, 59))
-df_filtrado = df_filtrado[(df_filtrado['created_at'].dt.time >= hora_inicio) & (df_filtrado['created_at'].dt.time <= hora_fim)]
-
 # ---------------------------------------
 # Correção do DataFrame
 # ---------------------------------------
-df_filtrado = df_filtrado[
-    df_filtrado['event_name'].str.contains("_", na=False) &
-    ~df_filtrado['event_name'].str.contains("{", na=False)
-]
-
 eventos_validos = [
     'outbound', 'ativação', 'outboud', 'cad'
 ]
 
 padrao_regex = '|'.join(eventos_validos)
 
-df_filtrado = df_filtrado[
-    df_filtrado['event_name'].str.contains(padrao_regex, case=False, na=False)
-]
-
 def extrair_template_e_tipo(event_name):
     event_name = event_name.lower()
 
@@ -137,9 +96,6 @@ def extrair_template_e_tipo(event_name):
 
     return pd.Series([template, tipo, categoria])
 
-df_filtrado[['template', 'tipo', 'categoria']] = df_filtrado['event_name'].apply(extrair_template_e_tipo)
-df_filtrado = df_filtrado[df_filtrado['template'] != 'desconhecido']
-
 
 NOMES_RESUMIDOS = {
     # Qualificado
@@ -207,47 +163,523 @@ NOMES_RESUMIDOS = {
     "opt_in_1st_cad_v3_resposta": "Optin 1st cad v3"
 }
 
-df_filtrado['nome_exibicao'] = df_filtrado['event_name'].map(NOMES_RESUMIDOS).fillna(df_filtrado['template'])
 
+def classificar_eventos(df):
+    """Remove eventos irrelevantes e adiciona template, tipo, categoria e nome de exibição."""
+    df = df[
+        df['event_name'].str.contains("_", na=False) &
+        ~df['event_name'].str.contains("{", na=False)
+    ]
+    df = df[df['event_name'].str.contains(padrao_regex, case=False, na=False)].copy()
+    if df.empty:
+        return df.assign(template=[], tipo=[], categoria=[], nome_exibicao=[])
+
+    df[['template', 'tipo', 'categoria']] = df['event_name'].apply(extrair_template_e_tipo)
+    df = df[df['template'] != 'desconhecido']
+
+    df['nome_exibicao'] = df['event_name'].map(NOMES_RESUMIDOS).fillna(df['template'])
+    return df
+
+
+# -------------------------------
+# Agregados compartilhados (dashboard + API)
+# -------------------------------
+@st.cache_data(ttl=600, max_entries=1)
+def carregar_eventos_classificados():
+    """Eventos classificados junto com a versão e as datas do mesmo carregamento.
+
+    A versão muda sempre que entram eventos novos e é usada como chave dos
+    agregados e dos ETags da API. Ela sai do mesmo DataFrame que é agregado,
+    para que um ETag nunca aponte para números de outra carga.
+    """
+    df = carregar_dados()
+    versao = f"{len(df)}-{df['created_at'].max():%Y%m%d%H%M%S%f}"
+    return versao, df['created_at'].min().date(), df['created_at'].max().date(), classificar_eventos(df)
+
+@st.cache_data(ttl=600)
+def versao_dados():
+    """Versão e primeira/última data dos eventos classificados em cache.
+
+    Devolve só escalares, para que a leitura no cache não desserialize a
+    coleção inteira a cada rerun ou requisição da API.
+    """
+    versao, data_min, data_max, _ = carregar_eventos_classificados()
+    return versao, data_min, data_max
+
+def filtrar_periodo(df, data_inicio, data_fim, hora_inicio, hora_fim):
+    df = df[(df['created_at'].dt.date >= data_inicio) & (df['created_at'].dt.date <= data_fim)]
+    return df[(df['created_at'].dt.time >= hora_inicio) & (df['created_at'].dt.time <= hora_fim)]
+
+def resumo_templates(df):
+    """Quantidade de eventos por tipo e taxa de resposta de cada template (Gráficos 1 e 2)."""
+    resumo = df.groupby(['nome_exibicao', 'tipo']).size().unstack(fill_value=0)
+    categorias = df.groupby(['nome_exibicao', 'categoria']).size().unstack(fill_value=0) \
+        .reindex(columns=['envio', 'resposta'], fill_value=0)
+    resumo['taxa_resposta'] = (categorias['resposta'] / categorias['envio']) \
+        .replace([float('inf'), float('nan')], 0) * 100
+    return resumo
+
+def taxa_diaria_templates(df):
+    """Taxa de resposta diária por template, limitada a (0, 100] (Gráfico 3)."""
+    contagem = df.assign(data=df['created_at'].dt.date) \
+        .groupby(['data', 'nome_exibicao', 'categoria']).size().unstack(fill_value=0) \
+        .reindex(columns=['envio', 'resposta'], fill_value=0)
+    taxa = (contagem['resposta'] / contagem['envio'].where(contagem['envio'] > 0)).fillna(0) * 100
+    taxa_diaria = taxa.rename('taxa_resposta').reset_index()
+    return taxa_diaria[(taxa_diaria['taxa_resposta'] > 0) & (taxa_diaria['taxa_resposta'] <= 100)]
+
+@st.cache_data(ttl=600, max_entries=64)
+def agregar_periodo(data_inicio, data_fim, hora_inicio, hora_fim, versao):
+    """Tabelas dos Gráficos 1–3 para um período; `versao` só entra na chave do cache."""
+    _, _, _, df = carregar_eventos_classificados()
+    df = filtrar_periodo(df, data_inicio, data_fim, hora_inicio, hora_fim)
+    return resumo_templates(df), taxa_diaria_templates(df)
+
+
+# -------------------------------
+# API HTTP local de métricas
+# -------------------------------
+# Outros consumidores leem os mesmos agregados do dashboard em vez de consultar
+# o MongoDB: GET /metrics/templates (Gráficos 1 e 2) e GET /metrics/diario
+# (Gráfico 3), com ?start=AAAA-MM-DD&end=AAAA-MM-DD&hour_start=HH:MM&hour_end=HH:MM.
+# Respostas em JSON ou Arrow (?format=arrow ou Accept: application/vnd.apache.arrow.stream),
+# com ETag derivado da versão dos dados para que If-None-Match devolva 304.
+#
+# Limitação: o Streamlit não tem gancho de inicialização, então a API só sobe
+# quando a página é executada pela primeira vez no processo. Depois de reiniciar
+# o servidor, abra o dashboard uma vez antes de apontar outros consumidores
+# para a porta abaixo; até lá eles recebem "connection refused".
+PORTA_API_METRICAS = st.secrets.get("metrics_api", {}).get("port", 8765)
+TIPO_ARROW = "application/vnd.apache.arrow.stream"
+
+def serializar_tabela(tabela, formato):
+    if formato == "arrow":
+        tabela_arrow = pa.Table.from_pandas(tabela, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, tabela_arrow.schema) as writer:
+            writer.write_table(tabela_arrow)
+        return sink.getvalue().to_pybytes()
+    tabela = tabela.astype({col: str for col in ['data'] if col in tabela.columns})
+    return tabela.to_json(orient="records", force_ascii=False).encode("utf-8")
+
+@st.cache_data(ttl=600, max_entries=128)
+def corpo_metricas(rota, data_inicio, data_fim, hora_inicio, hora_fim, formato, versao):
+    resumo, taxa_diaria = agregar_periodo(data_inicio, data_fim, hora_inicio, hora_fim, versao)
+    tabela = resumo.reset_index() if rota == "/metrics/templates" else taxa_diaria
+    return serializar_tabela(tabela, formato)
+
+class MetricasHandler(BaseHTTPRequestHandler):
+    rotas = ("/metrics/templates", "/metrics/diario")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in self.rotas:
+            self.responder_erro(404, "rota desconhecida")
+            return
+
+        try:
+            versao, data_min, data_max = versao_dados()
+        except (StopException, PyMongoError) as erro:  # StopException vem de st.stop() em get_client
+            self.responder_erro(503, f"dados indisponíveis: {erro!r}")
+            return
+        except Exception as erro:
+            self.responder_erro(500, f"erro interno: {erro!r}")
+            return
+
+        consulta = {chave: valores[0] for chave, valores in parse_qs(url.query).items()}
+        try:
+            data_inicio = date.fromisoformat(consulta.get("start", str(data_min)))
+            data_fim = date.fromisoformat(consulta.get("end", str(data_max)))
+            hora_inicio = dt_time.fromisoformat(consulta.get("hour_start", "00:01"))
+            hora_fim = dt_time.fromisoformat(consulta.get("hour_end", "23:59"))
+        except ValueError as erro:
+            self.responder_erro(400, str(erro))
+            return
+
+        formato = "arrow" if consulta.get("format") == "arrow" or TIPO_ARROW in self.headers.get("Accept", "") else "json"
+        chave = f"{versao}|{url.path}|{data_inicio}|{data_fim}|{hora_inicio}|{hora_fim}|{formato}"
+        etag = '"' + hashlib.sha1(chave.encode("utf-8")).hexdigest()[:20] + '"'
+
+        if_none_match = self.headers.get("If-None-Match", "")
+        if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+            self.responder(304, b"", etag=etag)
+            return
+
+        try:
+            corpo = corpo_metricas(url.path, data_inicio, data_fim, hora_inicio, hora_fim, formato, versao)
+        except (StopException, PyMongoError) as erro:
+            self.responder_erro(503, f"dados indisponíveis: {erro!r}")
+            return
+        except Exception as erro:
+            self.responder_erro(500, f"erro interno: {erro!r}")
+            return
+        tipo_conteudo = TIPO_ARROW if formato == "arrow" else "application/json"
+        self.responder(200, corpo, tipo_conteudo, etag=etag)
+
+    def responder_erro(self, status, mensagem):
+        self.responder(status, json.dumps({"erro": mensagem}).encode("utf-8"), "application/json")
+
+    def responder(self, status, corpo, tipo_conteudo=None, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Vary", "Accept")
+        if tipo_conteudo:
+            self.send_header("Content-Type", tipo_conteudo)
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, format, *args):
+        pass
+
+@st.cache_resource
+def iniciar_api_metricas():
+    """Sobe a API uma única vez por processo, compartilhando o cache com o dashboard."""
+    servidor = ThreadingHTTPServer(("127.0.0.1", PORTA_API_METRICAS), MetricasHandler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+# -------------------------------
+# Redução de séries temporais
+# -------------------------------
+# Acima de LIMITE_PONTOS_SVG pontos o gráfico passa a usar Scattergl (WebGL) e
+# as séries são reduzidas com LTTB, dividindo MAX_PONTOS_FIGURA entre elas.
+LIMITE_PONTOS_SVG = 1000
+MAX_PONTOS_FIGURA = 2000
+
+def lttb(x, y, limite):
+    """Índices dos pontos escolhidos pelo Largest-Triangle-Three-Buckets.
+
+    Mantém o primeiro e o último ponto e, em cada balde intermediário, o ponto
+    que forma o maior triângulo com o ponto anterior e a média do próximo balde.
+    """
+    n = len(x)
+    if limite >= n or limite < 3:
+        return np.arange(n)
+
+    tamanho_balde = (n - 2) / (limite - 2)
+    indices = [0]
+    anterior = 0
+    for i in range(limite - 2):
+        inicio = int(i * tamanho_balde) + 1
+        fim = int((i + 1) * tamanho_balde) + 1
+        proximo_fim = min(int((i + 2) * tamanho_balde) + 1, n)
+        media_x = x[fim:proximo_fim].mean()
+        media_y = y[fim:proximo_fim].mean()
+        areas = np.abs(
+            (x[anterior] - media_x) * (y[inicio:fim] - y[anterior]) -
+            (x[anterior] - x[inicio:fim]) * (media_y - y[anterior])
+        )
+        anterior = inicio + int(areas.argmax())
+        indices.append(anterior)
+    indices.append(n - 1)
+    return np.array(indices)
+
+def reduzir_series(df, coluna_x, coluna_y, coluna_serie, total=MAX_PONTOS_FIGURA):
+    """Aplica LTTB em cada série (template), com `total` pontos divididos entre as séries."""
+    limite = max(3, total // max(1, df[coluna_serie].nunique()))
+    partes = []
+    for _, serie in df.sort_values(coluna_x).groupby(coluna_serie, sort=False):
+        x = pd.to_datetime(serie[coluna_x]).astype('int64').to_numpy(dtype=float)
+        y = serie[coluna_y].to_numpy(dtype=float)
+        partes.append(serie.iloc[lttb(x, y, limite)])
+    return pd.concat(partes) if partes else df
+
+
+# -------------------------------
+# Prévia amostral (modo progressivo)
+# -------------------------------
+# Em períodos longos a prévia usa uma amostra estratificada por faixa de tempo
+# enquanto a carga completa ainda não terminou. Em cada estrato são sorteadas
+# janelas de uma hora (só dentro do horário filtrado) e lidos todos os eventos
+# delas, de modo que as consultas percorrem só o trecho sorteado do índice em
+# created_at. Sem esse índice cada consulta vira uma varredura da coleção, então
+# o modo progressivo é desativado (ver tem_indice_created_at).
+ESTRATOS_AMOSTRA = 12
+TAMANHO_AMOSTRA = 20_000
+JANELA_AMOSTRA = pd.Timedelta(hours=1)
+
+@st.cache_data(ttl=600)
+def tem_indice_created_at():
+    indices = get_client()["growth"]["events"].index_information()
+    return any(info["key"][0][0] == "created_at" for info in indices.values())
+
+@st.cache_data(ttl=600)
+def carregar_limites_datas():
+    """Primeira e última data dos eventos, sem carregar a coleção inteira."""
+    colecao = get_client()["growth"]["events"]
+    primeiro = colecao.find_one({}, {"created_at": 1}, sort=[("created_at", 1)])
+    ultimo = colecao.find_one({}, {"created_at": 1}, sort=[("created_at", -1)])
+    return pd.to_datetime(primeiro["created_at"]).date(), pd.to_datetime(ultimo["created_at"]).date()
+
+def juntar_janelas(inicios):
+    """Une janelas consecutivas em intervalos [inicio, fim) para reduzir o $or."""
+    intervalos = []
+    for inicio in inicios:
+        if intervalos and intervalos[-1][1] == inicio:
+            intervalos[-1][1] = inicio + JANELA_AMOSTRA
+        else:
+            intervalos.append([inicio, inicio + JANELA_AMOSTRA])
+    return intervalos
+
+@st.cache_data(ttl=600)
+def carregar_amostra(data_inicio, data_fim, hora_inicio, hora_fim, tamanho=TAMANHO_AMOSTRA):
+    """Amostra estratificada por conglomerados (janelas de uma hora) do período.
+
+    Em cada estrato h há W_h janelas dentro do horário filtrado; são sorteadas
+    m_h delas, sem reposição, para ler cerca de tamanho / ESTRATOS_AMOSTRA
+    eventos. Devolve os eventos (com estrato e janela) e a tabela das janelas
+    sorteadas, com W e m, usada por estimar_taxas. As contagens usam
+    count_documents, que o MongoDB resolve só no índice de created_at.
+    """
+    colecao = get_client()["growth"]["events"]
+    limites = list(pd.date_range(
+        datetime.combine(data_inicio, dt_time.min),
+        datetime.combine(data_fim, dt_time.min) + pd.Timedelta(days=1),
+        periods=ESTRATOS_AMOSTRA + 1
+    ).round('h'))
+
+    gerador = np.random.default_rng()
+    partes, sorteios = [], []
+    por_estrato = max(1, tamanho // ESTRATOS_AMOSTRA)
+    for estrato, (inicio, fim) in enumerate(zip(limites[:-1], limites[1:])):
+        total = colecao.count_documents({"created_at": {"$gte": inicio.to_pydatetime(), "$lt": fim.to_pydatetime()}})
+        if total == 0:
+            continue
+
+        todas = pd.date_range(inicio, fim, freq=JANELA_AMOSTRA, inclusive='left')
+        elegiveis = todas[(todas.hour >= hora_inicio.hour) & (todas.hour <= hora_fim.hour)]
+        if len(elegiveis) == 0:
+            continue
+        # total / len(todas) estima quantos eventos cabem em cada janela
+        sorteadas = min(len(elegiveis), max(1, int(np.ceil(len(todas) * por_estrato / total))))
+        escolhidas = elegiveis[np.sort(gerador.choice(len(elegiveis), size=sorteadas, replace=False))]
+        sorteios.append(pd.DataFrame({
+            "estrato": estrato, "janela": escolhidas, "W": len(elegiveis), "m": sorteadas,
+        }))
+
+        intervalos = juntar_janelas(escolhidas)
+        dados = list(colecao.find(
+            {"$or": [
+                {"created_at": {"$gte": ini.to_pydatetime(), "$lt": fim_janela.to_pydatetime()}}
+                for ini, fim_janela in intervalos
+            ]},
+            {"_id": 0, "event_name": 1, "created_at": 1}
+        ))
+        if dados:
+            partes.append(pd.DataFrame(dados).assign(estrato=estrato))
+
+    janelas = pd.concat(sorteios, ignore_index=True) if sorteios else pd.DataFrame({
+        "estrato": pd.Series(dtype=int),
+        "janela": pd.Series(dtype="datetime64[ns]"),
+        "W": pd.Series(dtype=int),
+        "m": pd.Series(dtype=int),
+    })
+    if not partes:
+        amostra = pd.DataFrame({
+            "event_name": pd.Series(dtype=object),
+            "created_at": pd.Series(dtype="datetime64[ns]"),
+            "estrato": pd.Series(dtype=int),
+        })
+    else:
+        amostra = pd.concat(partes, ignore_index=True)
+        amostra["created_at"] = pd.to_datetime(amostra["created_at"]).astype("datetime64[ns]")
+    amostra["janela"] = amostra["created_at"].dt.floor(JANELA_AMOSTRA)
+    return amostra, janelas
+
+def estimar_taxas(amostra, janelas, z=1.96):
+    """Taxa de resposta estimada por template com intervalo de confiança de 95%.
+
+    A taxa é o estimador de razão R = Y / X, com X e Y (envios e respostas)
+    expandidos por W_h / m_h. O intervalo vem da variância linearizada da razão
+    calculada sobre os totais por janela sorteada (inclusive janelas sem eventos
+    do template), o que leva em conta o agrupamento dos envios e respostas em
+    rajadas. Estratos com uma única janela sorteada não contribuem variância.
+    """
+    eventos = amostra.assign(
+        envio=(amostra['categoria'] == 'envio').astype(int),
+        resposta=(amostra['categoria'] == 'resposta').astype(int)
+    )
+    totais = eventos.groupby(['nome_exibicao', 'estrato', 'janela'])[['envio', 'resposta']].sum().reset_index()
+
+    # Todas as janelas sorteadas para cada template, com zero onde não houve eventos
+    grade = janelas.merge(pd.DataFrame({'nome_exibicao': totais['nome_exibicao'].unique()}), how='cross')
+    grade = grade.merge(totais, on=['nome_exibicao', 'estrato', 'janela'], how='left') \
+        .fillna({'envio': 0, 'resposta': 0})
+    grade['peso'] = grade['W'] / grade['m']
+
+    x_total = (grade['peso'] * grade['envio']).groupby(grade['nome_exibicao']).sum()
+    y_total = (grade['peso'] * grade['resposta']).groupby(grade['nome_exibicao']).sum()
+    razao = y_total / x_total.where(x_total > 0)
+
+    grade['residuo'] = grade['resposta'] - grade['nome_exibicao'].map(razao) * grade['envio']
+    por_estrato = grade.groupby(['nome_exibicao', 'estrato']).agg(
+        W=('W', 'first'), m=('m', 'first'), s2=('residuo', 'var')
+    )
+    por_estrato['variancia'] = (
+        por_estrato['W']**2 * (1 - por_estrato['m'] / por_estrato['W']) * por_estrato['s2'].fillna(0) / por_estrato['m']
+    )
+    erro_padrao = np.sqrt(por_estrato.groupby(level='nome_exibicao')['variancia'].sum()) / x_total
+
+    estimativa = pd.DataFrame({
+        'envios_amostrados': grade.groupby('nome_exibicao')['envio'].sum(),
+        'taxa_resposta': razao * 100,
+        'ic_inferior': (razao - z * erro_padrao).clip(lower=0) * 100,
+        'ic_superior': (razao + z * erro_padrao) * 100,
+    })
+    estimativa.index.name = 'nome_exibicao'
+    estimativa = estimativa[estimativa['taxa_resposta'].notna() & (estimativa['envios_amostrados'] > 0)]
+    return estimativa.reset_index().sort_values('taxa_resposta')
+
+st.set_page_config(
+    page_title="Meu Dashboard",
+    layout="wide",
+    initial_sidebar_state="expanded",
+)
+
+# Atualização periódica a cada 10 minutos
+_ = st_autorefresh(interval=600_000, limit=None, key="auto_refresh")
+
+try:
+    iniciar_api_metricas()
+except OSError:
+    st.sidebar.warning(f"⚠️ API de métricas indisponível: porta {PORTA_API_METRICAS} em uso.")
+
+# -------------------------------
+# Status da conexão e atualização
+# -------------------------------
+col1, col2 = st.columns(2)
+
+with col1:
+    try:
+        get_client().admin.command("ping")
+        st.success("✅ Conectado ao MongoDB")
+    except:
+        st.error("❌ Falha na conexão com o MongoDB")
+
+with col2:
+    st.caption(f"📅 Atualizado em: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+
+# -------------------------------
+# Filtros de data e horário
+# -------------------------------
+modo_progressivo = st.sidebar.checkbox(
+    "Modo progressivo (prévia amostral)",
+    value=False,
+    help="Mostra primeiro taxas estimadas a partir de uma amostra e substitui pelos números exatos ao fim da carga."
+)
+
+if modo_progressivo and not tem_indice_created_at():
+    st.sidebar.warning(
+        "⚠️ A coleção não tem índice em created_at; sem ele a amostra varreria a coleção "
+        "várias vezes. Modo progressivo desativado."
+    )
+    modo_progressivo = False
+
+# Carrega os dados (no modo progressivo, só os limites de data por enquanto)
+if modo_progressivo:
+    data_min, data_max = carregar_limites_datas()
+else:
+    _, data_min, data_max = versao_dados()
+data_inicio = st.sidebar.date_input("Data inicial", value=data_min, min_value=data_min, max_value=data_max)
+data_fim = st.sidebar.date_input("Data final", value=data_max, min_value=data_min, max_value=data_max)
+
+hora_inicio = st.sidebar.time_input("Hora inicial", value=dt_time(0, 1))
+hora_fim = st.sidebar.time_input("Hora final", value=dt_time(23, 59))
+
+# -------------------------------
+# Áreas dos Gráficos 1 e 2
+# -------------------------------
+# Criadas antes da carga completa para que a prévia ocupe o lugar do Gráfico 2
+# e seja substituída ali mesmo pelos números exatos.
+secao_grafico1 = st.container()
+secao_grafico2 = st.container()
+secao_grafico2.subheader("2 - Desempenho dos Templates: Taxa de respostas dos templates")
+area_grafico2 = secao_grafico2.empty()
+
+# -------------------------------
+# Prévia amostral
+# -------------------------------
+# Não redesenha a prévia quando os agregados exatos deste período já foram
+# calculados (ex.: reruns do autorefresh ou troca de templates).
+filtros_periodo = (data_inicio, data_fim, hora_inicio, hora_fim)
+if modo_progressivo and st.session_state.get("periodo_exato") != filtros_periodo:
+    inicio_previa = time.perf_counter()
+    amostra, janelas_amostra = carregar_amostra(data_inicio, data_fim, hora_inicio, hora_fim)
+    amostra = filtrar_periodo(classificar_eventos(amostra), data_inicio, data_fim, hora_inicio, hora_fim)
+    selecao_atual = st.session_state.get("templates_selecionados", ["Todos"])
+    if "Todos" not in selecao_atual and selecao_atual:
+        amostra = amostra[amostra['nome_exibicao'].isin(selecao_atual)]
+    estimativa = estimar_taxas(amostra, janelas_amostra)
+
+    fig_previa = go.Figure(go.Bar(
+        x=estimativa['taxa_resposta'],
+        y=estimativa['nome_exibicao'],
+        orientation='h',
+        error_x=dict(
+            type='data',
+            array=estimativa['ic_superior'] - estimativa['taxa_resposta'],
+            arrayminus=estimativa['taxa_resposta'] - estimativa['ic_inferior']
+        ),
+        customdata=estimativa[['ic_inferior', 'ic_superior', 'envios_amostrados']],
+        hovertemplate=(
+            "<b>Template:</b> %{y}<br>" +
+            "<b>Taxa estimada:</b> %{x:.1f}%<br>" +
+            "<b>IC 95%:</b> %{customdata[0]:.1f}% – %{customdata[1]:.1f}%<br>" +
+            "<b>Envios na amostra:</b> %{customdata[2]}<extra></extra>"
+        ),
+        marker=dict(color='rgba(58, 71, 80, 0.6)', line=dict(color='rgba(58, 71, 80, 1.0)', width=1))
+    ))
+    fig_previa.update_layout(
+        title="Prévia: Taxa de Resposta Estimada por Template (IC 95%)",
+        xaxis_title="Taxa de Resposta (%)",
+        yaxis_title="Template",
+        height=max(400, len(estimativa) * 25),
+        margin=dict(l=200, r=20, t=50, b=40)
+    )
+
+    with area_grafico2.container():
+        st.info(
+            f"⏳ Prévia com {len(amostra)} eventos amostrados "
+            f"({(time.perf_counter() - inicio_previa) * 1000:.0f} ms). "
+            "Os números exatos substituem esta prévia assim que a carga completa terminar."
+        )
+        st.plotly_chart(fig_previa, use_container_width=True)
 
+versao_atual, _, _ = versao_dados()
+resumo, taxa_diaria = agregar_periodo(data_inicio, data_fim, hora_inicio, hora_fim, versao_atual)
+st.session_state["periodo_exato"] = filtros_periodo
 
 # -------------------------------
 # Filtro de templates
 # -------------------------------
-templates_disponiveis = sorted(df_filtrado['nome_exibicao'].unique())
+templates_disponiveis = sorted(resumo.index)
 templates_selecionados = st.sidebar.multiselect(
     "Selecionar templates para análise",
     options=["Todos"] + templates_disponiveis,
-    default=["Todos"]
+    default=["Todos"],
+    key="templates_selecionados"
 )
 
-if "Todos" in templates_selecionados or not templates_selecionados:
-    df_filtrado = df_filtrado[df_filtrado['nome_exibicao'].isin(templates_disponiveis)]
-else:
-    df_filtrado = df_filtrado[df_filtrado['nome_exibicao'].isin(templates_selecionados)]
+if "Todos" not in templates_selecionados and templates_selecionados:
+    resumo = resumo[resumo.index.isin(templates_selecionados)]
+    taxa_diaria = taxa_diaria[taxa_diaria['nome_exibicao'].isin(templates_selecionados)]
 
 
 
 # -------------------------------
 # Gráfico 1: Barras empilhadas + linha
 # -------------------------------
-st.subheader("1 - Desempenho dos Templates: Envios e respostas")
-# Agrupamento por tipo
-distribuicao_resposta = df_filtrado.groupby(['nome_exibicao', 'tipo'])['tipo'] \
-    .size().unstack(fill_value=0).reset_index()
-
-# Agrupamento para taxa de resposta
-taxa_resposta = df_filtrado.groupby(['nome_exibicao', 'categoria'])['tipo'] \
-    .size().unstack(fill_value=0).reset_index()
-
-# Garantir colunas
-taxa_resposta['resposta'] = taxa_resposta.get('resposta', 0)
-taxa_resposta['envio'] = taxa_resposta.get('envio', 0)
-taxa_resposta['taxa_resposta'] = (taxa_resposta['resposta'] / taxa_resposta['envio']) \
-    .replace([float('inf'), float('nan')], 0) * 100
+secao_grafico1.subheader("1 - Desempenho dos Templates: Envios e respostas")
+# Quantidade por tipo (somente tipos presentes nos templates selecionados)
+distribuicao_resposta = resumo.drop(columns='taxa_resposta')
+distribuicao_resposta = distribuicao_resposta.loc[:, distribuicao_resposta.sum() > 0].reset_index()
 
 # Seleciona somente taxa + nome
-taxa_resposta = taxa_resposta[['nome_exibicao', 'taxa_resposta']]
+taxa_resposta = resumo[['taxa_resposta']].reset_index()
 
 # Ordena pela soma dos eventos (opcional)
 distribuicao_resposta['total'] = distribuicao_resposta.drop(columns='nome_exibicao').sum(axis=1)
@@ -321,11 +753,11 @@ fig1.update_layout(
 )
 
 
-st.plotly_chart(fig1, use_container_width=True)
+secao_grafico1.plotly_chart(fig1, use_container_width=True)
 
 
 
-st.write("---")
+secao_grafico1.write("---")
 
 
 
@@ -333,15 +765,8 @@ st.write("---")
 # -------------------------------
 # Gráfico 2: Taxa por template
 # -------------------------------
-st.subheader("2 - Desempenho dos Templates: Taxa de respostas dos templates")
-# Recria o DataFrame com taxa
-taxa_template = df_filtrado.groupby(['nome_exibicao', 'categoria'])['tipo'].size().unstack(fill_value=0)
-taxa_template['resposta'] = taxa_template.get('resposta', 0)
-taxa_template['envio'] = taxa_template.get('envio', 0)
-taxa_template['taxa_resposta'] = (taxa_template['resposta'] / taxa_template['envio']).fillna(0) * 100
-
 # Ordena por taxa de resposta
-taxa_template = taxa_template[['taxa_resposta']].reset_index().sort_values('taxa_resposta')
+taxa_template = resumo[['taxa_resposta']].reset_index().sort_values('taxa_resposta')
 
 # Calcula altura baseada na quantidade de barras
 altura = max(400, len(taxa_template) * 25)
@@ -367,11 +792,11 @@ fig2.update_layout(
 )
 
 
-st.plotly_chart(fig2, use_container_width=True)
+area_grafico2.plotly_chart(fig2, use_container_width=True)
 
 
 
-st.write("---")
+secao_grafico2.write("---")
 
 
 
@@ -379,17 +804,7 @@ st.write("---")
 # -------------------------------
 # Gráfico 3: Taxa de resposta semanal
 # -------------------------------
-# Adiciona a coluna de data
-df_filtrado['data'] = df_filtrado['created_at'].dt.date
-
-# Calcula a taxa de resposta diária
-taxa_diaria = df_filtrado.groupby(['data', 'nome_exibicao']).apply(
-    lambda x: (x['categoria'] == 'resposta').sum() / (x['categoria'] == 'envio').sum() * 100
-    if (x['categoria'] == 'envio').sum() > 0 else 0
-).reset_index(name='taxa_resposta')
-
-# Limita a taxa a 100% e filtra as taxas maiores que 0
-taxa_diaria = taxa_diaria[(taxa_diaria['taxa_resposta'] > 0) & (taxa_diaria['taxa_resposta'] <= 100)]
+# A taxa de resposta diária (já limitada a 100%) vem de agregar_periodo
 
 # Input do usuário para definir o Top N
 top_n = st.number_input("Escolha o número de templates (Top N):", min_value=1, max_value=50, value=10, step=1)
@@ -403,52 +818,73 @@ top_templates = media_taxa.head(top_n).index.tolist()
 # Filtra os dados para os Top N
 taxa_top = taxa_diaria[taxa_diaria['nome_exibicao'].isin(top_templates)]
 
-# Gera cores fixas por template
-nomes = sorted(taxa_top['nome_exibicao'].unique())
-paleta = px.colors.qualitative.Set2 + px.colors.qualitative.Set1
-cores = {nome: paleta[i % len(paleta)] for i, nome in enumerate(nomes)}
-
-# Cria o gráfico
-fig3 = go.Figure()
-
-# Adiciona as linhas de resposta ao gráfico
-for nome in nomes:
-    df_temp = taxa_top[taxa_top['nome_exibicao'] == nome]
-    fig3.add_trace(go.Scatter(
-        x=df_temp['data'],
-        y=df_temp['taxa_resposta'],
-        mode='lines+markers',
-        name=nome,
-        line=dict(color=cores[nome]),
-        hovertemplate=(
-            "<b>Template:</b> " + nome + "<br>" +
-            "<b>Data:</b> %{x|%d/%m/%Y}<br>" +
-            "<b>Taxa de Resposta:</b> %{y:.2f}%<extra></extra>"
-        )
-    ))
+@st.cache_resource(ttl=600, max_entries=16)
+def figura_temporal(taxa_top):
+    """Monta o Gráfico 3, cacheado por estado dos filtros.
+
+    Usa cache_resource para guardar o próprio go.Figure: cache_data o
+    desserializaria (e revalidaria) a cada rerun.
+    """
+    total_pontos = len(taxa_top)
+    usa_webgl = total_pontos > LIMITE_PONTOS_SVG
+    if usa_webgl:
+        taxa_top = reduzir_series(taxa_top, 'data', 'taxa_resposta', 'nome_exibicao')
+    Scatter = go.Scattergl if usa_webgl else go.Scatter
+
+    # Gera cores fixas por template
+    nomes = sorted(taxa_top['nome_exibicao'].unique())
+    paleta = px.colors.qualitative.Set2 + px.colors.qualitative.Set1
+    cores = {nome: paleta[i % len(paleta)] for i, nome in enumerate(nomes)}
+
+    # Cria o gráfico
+    fig3 = go.Figure()
+
+    # Adiciona as linhas de resposta ao gráfico
+    for nome, df_temp in taxa_top.groupby('nome_exibicao'):
+        fig3.add_trace(Scatter(
+            x=df_temp['data'],
+            y=df_temp['taxa_resposta'],
+            mode='lines+markers',
+            name=nome,
+            line=dict(color=cores[nome]),
+            hovertemplate=(
+                "<b>Template:</b> " + nome + "<br>" +
+                "<b>Data:</b> %{x|%d/%m/%Y}<br>" +
+                "<b>Taxa de Resposta:</b> %{y:.2f}%<extra></extra>"
+            )
+        ))
+
+    # Configura o layout
+    fig3.update_layout(
+        height=500,
+        xaxis=dict(
+            title="Data",
+            tickformat="%d/%m",
+            type='date'
+        ),
+        yaxis=dict(
+            title="Taxa de Resposta (%)",
+            range=[0, 100]
+        ),
+        legend=dict(
+            orientation="v",
+            yanchor="top",
+            y=1,
+            xanchor="left",
+            x=1.02
+        ),
+        margin=dict(l=40, r=140, t=20, b=60)
+    )
 
-# Configura o layout
-fig3.update_layout(
-    height=500,
-    xaxis=dict(
-        title="Data",
-        tickformat="%d/%m",
-        type='date'
-    ),
-    yaxis=dict(
-        title="Taxa de Resposta (%)",
-        range=[0, 100]
-    ),
-    legend=dict(
-        orientation="v",
-        yanchor="top",
-        y=1,
-        xanchor="left",
-        x=1.02
-    ),
-    margin=dict(l=40, r=140, t=20, b=60)
-)
+    return fig3, total_pontos, len(taxa_top), usa_webgl, len(fig3.to_json().encode('utf-8'))
 
 # Exibe o gráfico
 st.subheader("3 - Série Temporal de Engajamento por Template")
+inicio_render = time.perf_counter()
+fig3, total_pontos, pontos_exibidos, usa_webgl, tamanho_json = figura_temporal(taxa_top)
 st.plotly_chart(fig3, use_container_width=True)
+tempo_render = (time.perf_counter() - inicio_render) * 1000
+st.caption(
+    f"⚙️ {pontos_exibidos} de {total_pontos} pontos · {'WebGL' if usa_webgl else 'SVG'} · "
+    f"{tamanho_json / 1024:.0f} KB · tempo no servidor (cache + st.plotly_chart) {tempo_render:.0f} ms"
+)
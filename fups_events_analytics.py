@@ -1,5 +1,6 @@
 import time
 from datetime import time as dt_time
+import numpy as np
 import pandas as pd
 import plotly.express as px
 from plotly.subplots import make_subplots
@@ -39,6 +40,47 @@ def carregar_dados():
     df["created_at"] = pd.to_datetime(df["created_at"])
     return df
 
+# -------------------------------
+# Redução de séries temporais
+# -------------------------------
+# Acima de LIMITE_PONTOS_SVG pontos o gráfico passa a usar WebGL e as séries
+# são reduzidas com LTTB, dividindo MAX_PONTOS_FIGURA entre elas.
+LIMITE_PONTOS_SVG = 1000
+MAX_PONTOS_FIGURA = 2000
+
+def lttb(x, y, limite):
+    """Índices dos pontos escolhidos pelo Largest-Triangle-Three-Buckets."""
+    n = len(x)
+    if limite >= n or limite < 3:
+        return np.arange(n)
+
+    tamanho_balde = (n - 2) / (limite - 2)
+    indices = [0]
+    anterior = 0
+    for i in range(limite - 2):
+        inicio = int(i * tamanho_balde) + 1
+        fim = int((i + 1) * tamanho_balde) + 1
+        proximo_fim = min(int((i + 2) * tamanho_balde) + 1, n)
+        media_x = x[fim:proximo_fim].mean()
+        media_y = y[fim:proximo_fim].mean()
+        areas = np.abs(
+            (x[anterior] - media_x) * (y[inicio:fim] - y[anterior]) -
+            (x[anterior] - x[inicio:fim]) * (media_y - y[anterior])
+        )
+        anterior = inicio + int(areas.argmax())
+        indices.append(anterior)
+    indices.append(n - 1)
+    return np.array(indices)
+
+def reduzir_series(df, coluna_x, coluna_y, coluna_serie, total=MAX_PONTOS_FIGURA):
+    limite = max(3, total // max(1, df[coluna_serie].nunique()))
+    partes = []
+    for _, serie in df.sort_values(coluna_x).groupby(coluna_serie, sort=False):
+        x = pd.to_datetime(serie[coluna_x]).astype('int64').to_numpy(dtype=float)
+        y = serie[coluna_y].to_numpy(dtype=float)
+        partes.append(serie.iloc[lttb(x, y, limite)])
+    return pd.concat(partes) if partes else df
+
 # Carrega os dados
 df = carregar_dados()
 
@@ -229,22 +271,40 @@ df_semana = df_semana[df_semana['envio'] > 0].copy()
 df_semana['taxa_resposta_semanal'] = (df_semana['resposta'] / df_semana['envio']) * 100
 df_semana['semana'] = df_semana['semana'].dt.strftime('%Y-%m-%d')
 
-# Gráfico
-fig_temporal = px.line(
-    df_semana,
-    x='semana',
-    y='taxa_resposta_semanal',
-    color='template',
-    title='Taxa de Resposta Geral por Semana',
-    labels={'taxa_resposta_semanal': 'Taxa de Resposta (%)', 'semana': 'Semana'},
-    markers=True
-)
+# Gráfico (go.Figure cacheado por estado dos filtros; cache_resource evita
+# desserializar e revalidar a figura a cada rerun)
+@st.cache_resource(ttl=600, max_entries=16)
+def figura_temporal(df_semana):
+    total_pontos = len(df_semana)
+    usa_webgl = total_pontos > LIMITE_PONTOS_SVG
+    if usa_webgl:
+        df_semana = reduzir_series(df_semana, 'semana', 'taxa_resposta_semanal', 'template')
+
+    fig_temporal = px.line(
+        df_semana,
+        x='semana',
+        y='taxa_resposta_semanal',
+        color='template',
+        title='Taxa de Resposta Geral por Semana',
+        labels={'taxa_resposta_semanal': 'Taxa de Resposta (%)', 'semana': 'Semana'},
+        markers=True,
+        render_mode='webgl' if usa_webgl else 'svg'
+    )
 
-fig_temporal.update_layout(
-    xaxis_title='Semana',
-    yaxis_title='Taxa de Resposta (%)',
-    height=600,
-    width=800
-)
+    fig_temporal.update_layout(
+        xaxis_title='Semana',
+        yaxis_title='Taxa de Resposta (%)',
+        height=600,
+        width=800
+    )
 
+    return fig_temporal, total_pontos, len(df_semana), usa_webgl, len(fig_temporal.to_json().encode('utf-8'))
+
+inicio_render = time.perf_counter()
+fig_temporal, total_pontos, pontos_exibidos, usa_webgl, tamanho_json = figura_temporal(df_semana)
 st.plotly_chart(fig_temporal, use_container_width=True)
+tempo_render = (time.perf_counter() - inicio_render) * 1000
+st.caption(
+    f"⚙️ {pontos_exibidos} de {total_pontos} pontos · {'WebGL' if usa_webgl else 'SVG'} · "
+    f"{tamanho_json / 1024:.0f} KB · tempo no servidor (cache + st.plotly_chart) {tempo_render:.0f} ms"
+)